@@ -0,0 +1,70 @@
+# asynctest.py Demo of usched threads running under an asyncio event loop
+# Author: Peter Hinch
+
+# Run on a host PC under CPython, with the lib directory on the path:
+# PYTHONPATH=lib python3 asynctest.py
+# A usched thread echoes lines written to a pipe by an asyncio coroutine, blocking on a Readable rather than polling.
+# Another usched thread awaits an asyncio coroutine, and a coroutine awaits the result of a usched thread. A Delay
+# instance runs throughout. The process sleeps whenever no thread is due.
+
+import os
+import asyncio
+from usched import Timeout
+from delay import Delay
+from asyncbridge import AsyncSched, Readable, await_future
+
+# THREADS:
+
+def reader(objSched, fd):                                   # Echo data arriving on a pipe
+    wf = Readable(objSched, fd, 2)                          # Two second timeout
+    while True:
+        reason = (yield wf())
+        if reason[0]:
+            data = os.read(fd, 100)
+            if not data:                                    # Writer has closed the pipe
+                break
+            print("usched got", data.decode().strip())
+        else:
+            print("usched reader timed out")
+    wf.close()
+
+async def slow_square(x):                                   # Coroutine awaited by a usched thread
+    await asyncio.sleep(0.2)
+    return x*x
+
+def squarer(objSched):
+    for x in range(3):
+        result = yield from await_future(objSched, slow_square(x))
+        print("usched thread awaited", result)
+
+def counter(n):                                             # usched thread awaited by a coroutine
+    wf = Timeout(0.1)
+    total = 0
+    for x in range(n):
+        total += x
+        yield wf()
+    return total
+
+# COROUTINES:
+
+async def writer(fd):
+    for x in range(5):
+        await asyncio.sleep(0.3)
+        os.write(fd, "line {:d}\n".format(x).encode())
+    os.close(fd)
+
+async def main():
+    objSched = AsyncSched()
+    rfd, wfd = os.pipe()
+    objSched.add_thread(reader(objSched, rfd))
+    objSched.add_thread(squarer(objSched))
+    Delay(objSched, lambda : print("Delay timed out")).trigger(1)
+    sched = asyncio.ensure_future(objSched.run_async())
+    result = await objSched.spawn(counter(10))
+    print("coroutine awaited usched thread:", result)
+    await writer(wfd)
+    await sched                                             # Scheduler stops when all threads are complete
+    os.close(rfd)
+    print("Done")
+
+asyncio.run(main())
@@ -0,0 +1,66 @@
+# bargraph.py Demo of the LCD driver's custom character cache: a bar graph and an animated icon
+# Author: Peter Hinch
+# Display must use the Hitachi HD44780 controller. This demo assumes a 16*2 character unit.
+
+import pyb
+from usched import Sched, Timeout, wait
+from lcdthread import LCD, PINLIST                          # Library supporting Hitachi LCD module
+
+# HARDWARE
+# As for lcdtest.py
+
+# The graph shows 15 bars each spanning both rows, so each bar has 16 levels. A cell is blank, a solid block (0xFF
+# in the controller's ROM) or one of seven partially filled glyphs. Column 15 of the top row shows a heart which
+# alternates between two glyphs. That's nine glyphs in total but no more than eight are ever visible, so once the
+# cache has warmed up glyphs are only uploaded when the heart is redrawn.
+
+BARS = 15
+PARTIAL = [chr(0x80 + n) for n in range(8)]                 # Keys: PARTIAL[n] has n rows lit. PARTIAL[0] unused
+HEART = (chr(0x88), chr(0x89))
+HEARTMAPS = ((0x00, 0x0a, 0x1f, 0x1f, 0x0e, 0x04, 0x00, 0x00),
+             (0x00, 0x00, 0x0a, 0x0e, 0x04, 0x00, 0x00, 0x00))
+
+# THREADS:
+
+def stop(fTim, objSch):                                     # Stop the scheduler after fTim seconds
+    yield from wait(fTim)
+    objSch.stop()
+
+def cell(level):                                            # Character for a cell showing 0-8 rows
+    if level <= 0:
+        return ' '
+    if level >= 8:
+        return '\xff'
+    return PARTIAL[level]
+
+def graph_thread(mylcd):
+    for n in range(1, 8):                                   # Register the bar glyphs: n rows lit from the bottom
+        mylcd.glyph(PARTIAL[n], [0x1f if row >= 8 - n else 0 for row in range(8)])
+    for key, bitmap in zip(HEART, HEARTMAPS):
+        mylcd.glyph(key, bitmap)
+    levels = [0]*BARS
+    wf = Timeout(0.1)
+    beat = 0
+    while True:
+        for bar in range(BARS):                             # Random walk
+            levels[bar] = min(16, max(0, levels[bar] + (pyb.rng() % 5) - 2))
+        mylcd[0] = "".join(cell(level - 8) for level in levels) + HEART[beat // 5]
+        mylcd[1] = "".join(cell(level) for level in levels)
+        beat = (beat + 1) % 10
+        yield wf()
+
+# USER TEST PROGRAM
+# Runs forever unless you pass a number of seconds
+
+def test(duration = 0):
+    if duration:
+        print("Test LCD bar graph for {:3d} seconds".format(duration))
+    objSched = Sched()
+    lcd0 = LCD(PINLIST, objSched, cols = 16)
+    objSched.add_thread(graph_thread(lcd0))
+    if duration:
+        objSched.add_thread(stop(duration, objSched))
+    objSched.run()
+    print("{:d} bytes sent to LCD, {:d} glyph uploads".format(lcd0.bytecount, lcd0.uploads))
+
+test(20)
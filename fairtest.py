@@ -0,0 +1,62 @@
+# fairtest.py Benchmark of the scheduler's fair share mode: CPU share and latency of round robin threads
+# Author: Peter Hinch
+
+# Runs on the MicroPython board or on a host PC (PYTHONPATH=lib python3 fairtest.py)
+# Three round robin threads run for 50uS, 1mS and 5mS per execution. Each is run with and without fair share mode
+# and the benchmark reports each thread's share of the CPU, Jain's fairness index of the weighted shares (1.0 is
+# perfectly fair) and the median, 99th percentile and maximum interval between executions of the cheap thread.
+# A second fair share run gives the cheap thread a weight of 4.
+
+from usched import Sched, Roundrobin, wait, micros, microsSince
+
+COSTS = (50, 1000, 5000)                                    # uS per execution
+
+# THREADS:
+
+def stop(fTim, objSch):                                     # Stop the scheduler after fTim seconds
+    yield from wait(fTim)
+    objSch.stop()
+
+def spinner(cost, lstStats, lstGaps):                       # Busy for cost uS per execution. Accumulates its run time
+    wf = Roundrobin()                                       # in lstStats[0] and, if lstGaps is a list, records the
+    last = None                                             # intervals between its executions
+    while True:
+        start = micros()
+        if last is not None and lstGaps is not None:
+            lstGaps.append(start - last)
+        while microsSince(start) < cost:
+            pass
+        lstStats[0] += microsSince(start)
+        last = micros()
+        yield wf()
+
+# USER TEST PROGRAM
+
+def run(duration, fair, weights):
+    objSched = Sched()
+    if fair:
+        objSched.fairshare_enable()
+    stats = [[0] for cost in COSTS]
+    gaps = []
+    for n, cost in enumerate(COSTS):
+        objSched.add_thread(spinner(cost, stats[n], gaps if n == 0 else None), weights[n])
+    objSched.add_thread(stop(duration, objSched))
+    objSched.run()
+    total = sum(stat[0] for stat in stats)
+    shares = [stat[0]/total for stat in stats]
+    weighted = [share/weight for share, weight in zip(shares, weights)]
+    jain = sum(weighted)**2/(len(weighted)*sum(x*x for x in weighted))
+    gaps.sort()
+    pct = lambda p : gaps[min(len(gaps) - 1, int(p*len(gaps)))] if gaps else 0
+    label = "Fair {}".format(weights) if fair else "Round robin"
+    print("{:18s}".format(label) + "".join("{:7.1f}".format(100*share) for share in shares) +
+          "{:7.3f}{:8d}{:8d}{:8d}".format(jain, pct(0.5), pct(0.99), gaps[-1] if gaps else 0))
+
+def test(duration = 2):
+    print("{:18s}".format("Mode") + "".join("{:>6d}u".format(cost) for cost in COSTS) +
+          "   Jain     p50     p99     max (uS)")
+    run(duration, False, (1, 1, 1))
+    run(duration, True, (1, 1, 1))
+    run(duration, True, (4, 1, 1))
+
+test(2)
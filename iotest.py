@@ -0,0 +1,65 @@
+# iotest.py Demo of threads blocking on stream I/O with IOWait
+# Author: Peter Hinch
+
+# Run on a host PC under CPython, with the lib directory on the path:
+# PYTHONPATH=lib python3 iotest.py
+# Twenty echo threads each service one end of a socket pair, blocking on an IOWait. A client thread sends a message
+# down each connection in turn and waits for the echoes. All the sockets are checked by one poll call per scheduler
+# pass, and the scheduler sleeps in that call while waiting, so CPU usage is low.
+
+import time
+import select
+import socket
+from usched import Sched, IOWait, Timeout
+
+CONNECTIONS = 20
+ROUNDS = 50
+
+# THREADS:
+
+def echo(objSched, sock):                                   # Echo data until the connection is closed
+    wf = IOWait(objSched, sock, select.POLLIN)
+    while True:
+        yield wf
+        data = sock.recv(1024)
+        if not data:
+            break
+        sock.send(data)
+    wf.close()
+    sock.close()
+
+def client(objSched, socks, lstResult):
+    wfs = [IOWait(objSched, sock, select.POLLIN, 1) for sock in socks]
+    pause = Timeout(0.01)
+    for n in range(ROUNDS):
+        for sock in socks:
+            sock.send("message {:d}".format(n).encode())
+        for sock, wf in zip(socks, wfs):
+            reason = (yield wf())
+            if reason[0] and sock.recv(1024) == "message {:d}".format(n).encode():
+                lstResult[0] += 1
+        yield pause()
+    for sock, wf in zip(socks, wfs):
+        wf.close()
+        sock.close()
+
+# USER TEST PROGRAM
+
+def test():
+    objSched = Sched()
+    clients = []
+    for n in range(CONNECTIONS):
+        a, b = socket.socketpair()
+        objSched.add_thread(echo(objSched, b))
+        clients.append(a)
+    lstResult = [0]
+    objSched.add_thread(client(objSched, clients, lstResult))
+    objSched.profile_enable()
+    start = time.perf_counter()
+    cpu = time.process_time()
+    objSched.run()
+    print("{:d} of {:d} echoes received in {:d} passes".format(lstResult[0], CONNECTIONS*ROUNDS, objSched.profpasses))
+    print("Elapsed {:5.2f}s CPU {:5.2f}s".format(time.perf_counter() - start, time.process_time() - cpu))
+
+if __name__ == '__main__':
+    test()
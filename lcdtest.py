@@ -10,7 +10,8 @@ from lcdthread import LCD, PINLIST                          # Library supporting
 # HARDWARE
 # Micropython board with LCD attached using the 4-wire data interface. See lcdthread.py for the
 # default pinout. If yours is wired differently, declare a pinlist as per the details in lcdthread
-# and instantiate the LCD using that list.
+# and instantiate the LCD using that list. If the LCD's RW pin is wired, append its pin to the list
+# to enable the busy flag to be read.
 
 # THREADS:
 
@@ -36,6 +37,8 @@ def test(duration = 0):
     if duration:
         objSched.add_thread(stop(duration, objSched))
     objSched.run()
+    print("{:d} bytes sent to LCD, {:d}uS spent in lcd_nybble".format(lcd0.bytecount, lcd0.nybble_uS))
+    print("LCD thread held the CPU for at most {:d}uS".format(lcd0.maxslice_uS))
 
 test(20)
 
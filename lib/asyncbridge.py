@@ -0,0 +1,185 @@
+# asyncbridge.py Runs usched threads under an asyncio event loop on a host (e.g. Linux) under CPython
+# Author: Peter Hinch
+
+# On a host usched threads such as those of the Delay class, or threads blocking on Poller or Timeout objects, may
+# need to run alongside asyncio code. Running Sched.run() in the same process would give two competing busy loops.
+# AsyncSched is a Sched whose loop is driven by asyncio: each scheduling pass runs as an event loop callback, and
+# between passes control returns to the event loop.
+# After each pass AsyncSched determines when a thread will next be due. If one is ready now (e.g. a Roundrobin) the
+# next pass is scheduled with loop.call_soon. If the earliest is a timeout it's scheduled with loop.call_at. Threads
+# blocked on a poll function are polled every pollinterval seconds. If all threads are waiting on events nothing is
+# scheduled: the event's callback wakes the scheduler. The process therefore sleeps while there is nothing to do.
+# Events which can wake threads:
+# Readable: a thread blocks until a file descriptor is readable. This stands in for Pinblock: the event loop's
+# add_reader callback increments the interrupt count, so the thread receives (count, 0, 0) or (0, 0, uS late) if it
+# timed out.
+# Futurewait: a thread blocks until an asyncio future or coroutine completes. The await_future generator wraps this:
+# result = yield from await_future(objSched, coro())
+# Coroutines can await completion of a usched thread: spawn adds a thread and returns a future whose result is the
+# thread's return value
+# result = await objSched.spawn(mythread())
+# Usage:
+# objSched = AsyncSched()
+# objSched.add_thread(...)
+# await objSched.run_async()                                Returns when stop() is called or all threads terminate
+# If a thread raises an exception the scheduler stops and run_async() (or run()) raises it.
+# Readable and Futurewait instances register with the event loop when the scheduler first polls them, so threads using
+# them may be added before the scheduler is started.
+
+import asyncio
+from usched import Sched, Waitfor, seconds
+
+class AsyncSched(Sched):
+    POLLINTERVAL = 0.001                                    # Default interval between calls to poll functions (secs)
+    def __init__(self, pollinterval = POLLINTERVAL):
+        super().__init__()
+        self.pollwait = seconds(pollinterval)               # uS
+        self.loop = None                                    # Event loop: set by run_async
+        self.handle = None                                  # Callback handle of next scheduled pass
+        self.finished = None                                # Future: done when the scheduler stops
+
+    async def run_async(self):                              # Run the scheduler until stopped or all threads terminate
+        self.loop = asyncio.get_running_loop()
+        self.finished = self.loop.create_future()
+        self.bStop = False
+        self.wake()
+        await self.finished
+
+    def run(self):                                          # Run an event loop with just this scheduler in it
+        asyncio.run(self.run_async())
+
+    def stop(self):
+        super().stop()
+        self.wake()                                         # Ensure the stop is noticed
+
+    def wake(self):                                         # Schedule a pass ASAP. Must be called in the loop's thread
+        if self.loop is None or self.finished.done():
+            return
+        if self.handle is not None:
+            self.handle.cancel()
+        self.handle = self.loop.call_soon(self._step)
+
+    def wake_threadsafe(self):                              # Schedule a pass from another thread
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wake)
+
+    def spawn(self, func):                                  # Add a thread. Return a future for its return value
+        future = asyncio.get_running_loop().create_future()
+        self.add_thread(self._resolve(func, future))
+        return future
+
+    def _resolve(self, func, future):                       # Thread: run func, passing its result to a future
+        try:
+            result = yield from func
+        except Exception as e:                              # Thread has failed: coroutine gets the exception
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    def _step(self):                                        # Event loop callback: run a pass, then schedule the next
+        self.handle = None
+        if self.finished.done():
+            return
+        if self.bStop or len(self.lstThread) == 0:
+            self.finished.set_result(None)
+            return
+        try:
+            self._runpass()
+        except BaseException as e:                          # A thread failed: the exception is raised by run_async()
+            if self.handle is not None:                     # rather than lost in the event loop's handler
+                self.handle.cancel()
+                self.handle = None
+            self.finished.set_exception(e)
+            return
+        if self.bStop or len([thread for thread in self.lstThread if thread[1] is not None]) == 0:
+            self.finished.set_result(None)
+            return
+        if self.handle is not None:                         # A thread woke us during the pass
+            return
+        due = self._timetorun(self.pollwait)
+        if due == 0:
+            self.handle = self.loop.call_soon(self._step)
+        elif due is not None:                               # Otherwise sleep until woken by an event
+            self.handle = self.loop.call_at(self.loop.time() + due/1000000, self._step)
+
+# ************************************************* EVENT WAITFORS **************************************************
+
+class Readable(Waitfor):                                    # Block until a file descriptor is readable, subject to an
+    def __init__(self, objSched, fd, timeout = None):       # optional timeout. The thread should read the data.
+        super().__init__()
+        self.objSched = objSched
+        self.fd = fd
+        self.irq = self                                     # Stands in for a pyb.ExtInt instance
+        self.armed = False
+        if timeout is None:
+            self.forever = True
+        else:
+            self.setdelay(timeout)
+
+    def _arm(self):                                         # Readiness callbacks are one-shot so that the event loop
+        self.objSched.loop.add_reader(self.fd, self._ready) # doesn't spin while the thread is yet to read the data
+        self.armed = True
+
+    def _ready(self):                                       # Event loop callback
+        self.objSched.loop.remove_reader(self.fd)
+        self.armed = False
+        self.intcallback(self.fd)
+        self.objSched.wake()
+
+    def triggered(self):                                    # Arm on first use, and rearm when an event is passed to the
+        res = super().triggered()                           # thread: the event loop won't check the descriptor until
+        if not self.armed:                                  # the pass is complete, by which time the thread has read it
+            self._arm()
+        return res
+
+    def disable(self):                                      # ExtInt interface used by Waitfor.triggered. Callbacks run
+        pass                                                # in the scheduler's thread so there's nothing to do
+
+    def enable(self):
+        pass
+
+    def close(self):                                        # Stop monitoring the file descriptor
+        if self.armed:
+            self.objSched.loop.remove_reader(self.fd)
+            self.armed = False
+
+class Futurewait(Waitfor):                                  # Block until an asyncio future or coroutine is done,
+    def __init__(self, objSched, awaitable, timeout = None): # subject to an optional timeout
+        super().__init__()
+        self.objSched = objSched
+        self.irq = self
+        self.awaitable = awaitable
+        self.future = None                                  # Created on first use
+        if timeout is None:
+            self.forever = True
+        else:
+            self.setdelay(timeout)
+
+    def triggered(self):
+        if self.future is None:
+            self.future = asyncio.ensure_future(self.awaitable, loop = self.objSched.loop)
+            self.future.add_done_callback(self._done)
+        return super().triggered()
+
+    def _done(self, future):
+        self.intcallback(0)
+        self.objSched.wake()
+
+    def result(self):                                       # Result of the future. Raises its exception if it failed
+        return self.future.result()
+
+    def disable(self):
+        pass
+
+    def enable(self):
+        pass
+
+def await_future(objSched, awaitable, timeout = None):      # Generator for use in a usched thread: returns the result
+    wf = Futurewait(objSched, awaitable, timeout)           # of an awaitable. On timeout the awaitable is cancelled and
+    yield wf                                                # asyncio.TimeoutError is raised
+    if not wf.future.done():
+        wf.future.cancel()
+        raise asyncio.TimeoutError()
+    return wf.result()
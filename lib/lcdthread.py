@@ -3,7 +3,8 @@
 # V1.0 21 Aug 2014
 
 # Assumes an LCD with standard Hitachi HD44780 controller chip wired using four data lines
-# Code has only been tested on two line LCD displays
+# Code has only been tested on two line LCD displays. Four line displays, including 40*4 units with two controllers
+# each having its own enable line, are supported.
 
 # My code is based on this program written for the Raspberry Pi
 # http://www.raspberrypi-spy.co.uk/2012/07/16x2-lcd-module-control-using-python/
@@ -16,7 +17,7 @@
 # Date   : 26/07/2012
 
 import pyb
-from usched import Timeout, Roundrobin
+from usched import Timeout, Roundrobin, microsSince, seconds
 
 # **************************************************** LCD DRIVER ***************************************************
 
@@ -29,11 +30,15 @@ D7   14   3        Y3
 D6   13   4        Y4
 D5   12   5        Y5
 D4   11   6        Y6
+RW    5            (optional: ground it if the busy flag isn't to be read)
 """
 
 # *********************************** GLOBAL CONSTANTS: MICROPYTHON PIN NUMBERS *************************************
 
-# Supply as board pin numbers as a tuple Rs, E, D4, D5, D6, D7
+# Supply as board pin numbers as a tuple Rs, E, D4, D5, D6, D7 with an optional seventh element RW. For a display with
+# two controllers (40*4) E is a tuple of two pins, the first enabling the top two rows, the second the bottom two. If RW is supplied
+# the driver reads the controller's busy flag rather than imposing worst case delays. Note that when reading, the
+# display drives the data lines: with a 5V display the pins used for D4-D7 must be 5V tolerant.
 
 PINLIST = ('Y1','Y2','Y6','Y5','Y4','Y3')
 
@@ -54,54 +59,285 @@ PINLIST = ('Y1','Y2','Y6','Y5','Y4','Y3')
 # Assigning changed data to the LCD object sets a "dirty" flag for that line. The LCD's runlcd thread then updates the
 # hardware and clears the flag
 
+# Frame buffer and geometry:
+# Assigned text is stored as character codes in a bytearray per row: runlcd works entirely on these and on preallocated
+# buffers so that updating the display doesn't allocate. Row start addresses in DDRAM depend on the geometry (see
+# rowaddr). 40*4 displays are two 40*2 controllers: each controller has its own cursor, CGRAM cache and output queue,
+# and runlcd services them alternately so that while one is busy the other can be written.
+
+# Cell-level updates:
+# The LCD object holds a shadow copy of what is actually on the display. When a line is dirty runlcd compares it with
+# the shadow and sends only the characters which differ. The HD44780 auto-increments its DDRAM address after each
+# character, so the driver tracks the cursor and only issues a set address command when the next changed character
+# isn't where the cursor already is. Changing one digit on a line therefore costs two bytes rather than a whole row.
+# bytecount holds the number of bytes sent to the display and nybble_uS the time spent in lcd_nybble since
+# initialisation: these enable the saving to be measured.
+
 # Note that the lcd_nybble method uses explicit delays rather than yields. This is for two reasons.
 # The delays are short in the context of general runtimes and minimum likely yield delays, so won't
 # significantly impact performance. Secondly, using yield produced perceptibly slow updates to the display text.
 
+# Write engine:
+# If the RW pin is wired, once initialisation is complete the fixed delays are dropped: the E pulse is the only delay
+# in lcd_nybble. Before each byte runlcd reads the busy flag and, if the controller is still executing the previous
+# instruction, yields a Roundrobin rather than waiting. Without RW the busy flag reads as never set and the delays
+# in lcd_nybble pace the writes as before.
+# Rather than yielding after every character runlcd sends bytes in bursts: it yields when sending another byte to each
+# controller would take the time spent in the current burst over the budget passed to the constructor (in seconds).
+# byte_uS holds the time taken to send the last byte. At least one byte is sent to each controller per burst. A
+# larger budget gives faster display updates at the expense of the latency seen by other threads. The default budget
+# is BUDGET if RW is wired, otherwise zero: without RW each byte costs about 300uS so a burst is a single byte.
+# maxslice_uS records the longest time runlcd has held the CPU.
+
+# Custom characters:
+# The controller has 8 CGRAM slots for user defined characters. The glyph method registers a bitmap against a key
+# character, which is then used in the text assigned to a line like any other character: keys should be chosen from
+# characters the application doesn't otherwise display. Keys must have codes in the range 16-255: codes 0-15 address
+# CGRAM directly, so characters in this range in assigned text are displayed as spaces. With two controllers each has
+# its own CGRAM.
+# Registered glyphs are mapped onto CGRAM slots on demand. A glyph is uploaded only if it isn't already resident,
+# evicting the least recently used slot, preferring one which isn't currently on screen. Cells still showing an
+# evicted glyph are redrawn. An application may register any number of glyphs, but no more than 8 distinct glyphs
+# can be visible at once: exceeding this causes continual uploads. uploads counts CGRAM uploads.
+
+# Overload:
+# The LCD registers a shed handler with the scheduler. If overload detection is enabled (Sched.overload_enable) then
+# while the scheduler is overloaded runlcd checks for changed text every SHEDPERIOD seconds rather than every 20mS,
+# reverting when the lag recovers. shedding is True while the refresh rate is reduced.
+
+# DDRAM start address of each row of a controller, indexed by no. of rows. 1 and 2 row units start the second row at
+# 40H. 4 row units with a single controller are a 2 row display folded in half: rows 2 and 3 continue rows 0 and 1.
+# A controller has two lines of 40 characters: larger displays need two controllers.
+def rowaddr(cols, rows):
+    if cols > 40 or cols*rows > 80:
+        raise ValueError("A controller can't drive {} rows of {} characters".format(rows, cols))
+    if rows <= 2:
+        return (0, 0x40)[:rows]
+    return (0, 0x40, cols, 0x40 + cols)
+
+class Controller(object):                                   # State of one HD44780 controller
+    def __init__(self, pin_name, rows):
+        self.LCD_E = pyb.Pin(pin_name, pyb.Pin.OUT_PP)
+        self.rows = rows                                    # Display rows driven by this controller
+        self.cursor = None                                  # DDRAM address command for next char. None == unknown
+        self.obuf = bytearray(LCD.CGSLOTS + 3)              # Bytes needed to update a cell: worst case is a glyph
+        self.omode = bytearray(LCD.CGSLOTS + 3)             # upload, an address command and the character
+        self.olen = 0                                       # No. of bytes queued
+        self.opos = 0                                       # No. sent
+        self.scanrow = 0                                    # Progress of runlcd through the rows: index into rows
+        self.scancol = 0
+        self.cgmap = {}                                     # Slot of each resident glyph indexed by character code
+        self.cgkey = [None]*LCD.CGSLOTS                     # Character code of the glyph in each slot
+        self.cgtime = [0]*LCD.CGSLOTS                       # Time each slot was last used
+        self.cgrefs = [0]*LCD.CGSLOTS                       # No. of cells currently showing each slot
+
 class LCD(object):                                          # LCD objects appear as read/write lists
     INITSTRING = (0x33, 0x32, 0x28, 0x0C, 0x06, 0x01)
-    LCD_LINES = (0x80, 0xC0)                                # LCD RAM address for the 1st and 2nd line (0 and 40H)
     CHR = True
     CMD = False
+    LCD_LINES = (0x80, 0xC0)                                # LCD RAM address for the 1st and 2nd line (0 and 40H)
     E_PULSE = 50                                            # Timing constants in uS
     E_DELAY = 50
-    def __init__(self, pinlist, scheduler, cols, rows = 2): # Init with pin nos for enable, rs, D4, D5, D6, D7
+    BUDGET = 0.001                                          # Default time budget of a burst if RW is wired (secs)
+    CGSLOTS = 8                                             # No. of user definable characters
+    SHEDPERIOD = 0.2                                        # Refresh interval while the scheduler is overloaded (secs)
+    def __init__(self, pinlist, scheduler, cols, rows = 2, budget = None): # Init with pin nos for enable, rs, D4-D7[, RW]
         self.initialising = True
-        self.LCD_E = pyb.Pin(pinlist[1], pyb.Pin.OUT_PP)    # Create and initialise the hardware pins
-        self.LCD_RS = pyb.Pin(pinlist[0], pyb.Pin.OUT_PP)
-        self.datapins = [pyb.Pin(pin_name, pyb.Pin.OUT_PP) for pin_name in pinlist[2:]]
+        epins = pinlist[1] if isinstance(pinlist[1], tuple) else (pinlist[1],)
+        rowsper = rows // len(epins)                        # Rows driven by each controller
+        self.controllers = [Controller(pin_name, list(range(n*rowsper, (n + 1)*rowsper)))
+                            for n, pin_name in enumerate(epins)]
+        self.LCD_E = self.controllers[0].LCD_E              # Enable pin of the currently selected controller
+        self.LCD_RS = pyb.Pin(pinlist[0], pyb.Pin.OUT_PP)   # Create and initialise the hardware pins
+        self.datapins = [pyb.Pin(pin_name, pyb.Pin.OUT_PP) for pin_name in pinlist[2:6]]
+        self.LCD_RW = None
+        if len(pinlist) > 6:                                # Busy flag can be read
+            self.LCD_RW = pyb.Pin(pinlist[6], pyb.Pin.OUT_PP)
+            self.LCD_RW.value(False)                        # Write mode
+        self.e_pulse = LCD.E_PULSE
+        self.e_delay = LCD.E_DELAY
+        if budget is None:
+            budget = LCD.BUDGET if self.LCD_RW is not None else 0
+        self.budget = seconds(budget)                       # uS
+        self.maxslice_uS = 0
         self.cols = cols
         self.rows = rows
+        addr = rowaddr(cols, rowsper)
+        self.rowctrl = [self.controllers[row // rowsper] for row in range(rows)]
+        self.rowaddr = bytearray(0x80 | addr[row % rowsper] for row in range(rows)) # Set DDRAM address commands
         self.lines = [""]*self.rows
-        self.dirty = [False]*self.rows
-        for thisbyte in LCD.INITSTRING:
-            self.lcd_byte(thisbyte, LCD.CMD)
-            self.initialising = False                       # Long delay after first byte only
+        self.fb = [bytearray(b' '*cols) for row in range(rows)] # Frame buffer: character codes assigned by the user
+        self.dirty = bytearray(rows)
+        self.shadow = [bytearray(b' '*cols) for row in range(rows)] # Contents of the display: cleared by INITSTRING
+        self.glyphs = {}                                    # Custom characters: bitmap indexed by character code
+        self.cgclock = 0
+        self.uploads = 0                                    # No. of CGRAM uploads
+        self.bytecount = 0
+        self.nybble_uS = 0
+        for ctrl in self.controllers:
+            self.select(ctrl)
+            self.initialising = True
+            for thisbyte in LCD.INITSTRING:
+                self.lcd_byte(thisbyte, LCD.CMD)
+                self.initialising = False                   # Long delay after first byte only
+        if self.LCD_RW is not None:                         # Busy flag is valid once initialised: the flag rather
+            self.e_pulse = 1                                # than fixed delays now governs timing. Min E pulse 450nS
+            self.e_delay = 0
+        self.bytecount = 0                                  # Statistics: don't include initialisation
+        self.nybble_uS = 0
+        self.byte_uS = 0
+        self.shedding = False
+        scheduler.add_shed_handler(self.shed)
         scheduler.add_thread(runlcd(self))
 
+    def shed(self, overloaded):                             # Scheduler shed handler: reduce the refresh rate while
+        self.shedding = overloaded                          # overloaded
+
+    def select(self, ctrl):                                 # Subsequent I/O is with this controller
+        self.LCD_E = ctrl.LCD_E
+
     def lcd_nybble(self, bits):                             # send the LS 4 bits
+        start = pyb.micros()
         for pin in self.datapins:
             pin.value(bits & 0x01)
             bits >>= 1
-        pyb.udelay(LCD.E_DELAY)    
+        if self.e_delay:
+            pyb.udelay(self.e_delay)
         self.LCD_E.value(True)                              # Toggle the enable pin
-        pyb.udelay(LCD.E_PULSE)
+        pyb.udelay(self.e_pulse)
         self.LCD_E.value(False)
         if self.initialising:
             pyb.delay(5)
-        else:
-            pyb.udelay(LCD.E_DELAY)      
+        elif self.e_delay:
+            pyb.udelay(self.e_delay)
+        self.nybble_uS += microsSince(start)
 
     def lcd_byte(self, bits, mode):                         # Send byte to data pins: bits = data
+        start = pyb.micros()
         self.LCD_RS.value(mode)                             # mode = True  for character, False for command
         self.lcd_nybble(bits >>4)                           # send high bits
         self.lcd_nybble(bits)                               # then low ones
+        self.bytecount += 1
+        self.byte_uS = microsSince(start)
 
-    def __setitem__(self, line, message):                   # Send string to display line 0 or 1
+    def busy(self):                                         # Read the busy flag. Always False if RW isn't wired
+        if self.LCD_RW is None:
+            return False
+        for pin in self.datapins:
+            pin.init(pyb.Pin.IN, pyb.Pin.PULL_NONE)
+        self.LCD_RS.value(LCD.CMD)
+        self.LCD_RW.value(True)
+        self.LCD_E.value(True)
+        pyb.udelay(1)                                       # Data valid 360nS after E rises
+        bf = self.datapins[3].value()                       # D7 holds the busy flag
+        self.LCD_E.value(False)
+        self.LCD_E.value(True)                              # Clock out and discard the low nybble
+        pyb.udelay(1)
+        self.LCD_E.value(False)
+        self.LCD_RW.value(False)
+        for pin in self.datapins:
+            pin.init(pyb.Pin.OUT_PP)
+        return bool(bf)
+
+    def queue(self, ctrl, bits, mode):                      # Append a byte to a controller's output queue
+        ctrl.obuf[ctrl.olen] = bits
+        ctrl.omode[ctrl.olen] = mode
+        ctrl.olen += 1
+
+    def lcd_cell(self, row, col):                           # Queue the bytes which will make a cell show its frame
+        ctrl = self.rowctrl[row]                            # buffer contents. Return the number queued: 0 if the
+        ctrl.olen = 0                                       # cell is up to date
+        ctrl.opos = 0
+        code = self.fb[row][col]
+        shadow = self.shadow[row]
+        old = shadow[col]
+        if old < LCD.CGSLOTS:                               # Cell may be about to lose its glyph
+            ctrl.cgrefs[old] -= 1
+        if code in self.glyphs:
+            bits = self.cgslot(ctrl, code)                  # May queue a CGRAM upload
+            ctrl.cgrefs[bits] += 1
+        else:
+            bits = code
+        if bits != old:                                     # Only send characters which differ from the display
+            addr = self.rowaddr[row] + col
+            if addr != ctrl.cursor:
+                self.queue(ctrl, addr, LCD.CMD)
+            self.queue(ctrl, bits, LCD.CHR)
+            shadow[col] = bits
+            ctrl.cursor = addr + 1                          # Controller auto-increments the address
+        return ctrl.olen
+
+    def refill(self, ctrl):                                 # Scan a controller's dirty rows for the next cell needing
+        rows = ctrl.rows                                    # an update and queue its bytes. Return False when the
+        while ctrl.scanrow < len(rows):                     # scan is complete
+            row = rows[ctrl.scanrow]
+            if ctrl.scancol == 0:
+                if not self.dirty[row]:
+                    ctrl.scanrow += 1
+                    continue
+                self.dirty[row] = False                     # Clear first: a change while we're writing re-flags it
+            while ctrl.scancol < self.cols:
+                col = ctrl.scancol
+                ctrl.scancol += 1
+                if self.lcd_cell(row, col):
+                    return True
+            ctrl.scanrow += 1
+            ctrl.scancol = 0
+        return False
+
+    def glyph(self, key, bitmap):                           # Register a custom character. key is a single character
+        if len(bitmap) != 8:                                # which will be displayed as the glyph. bitmap holds 8
+            raise ValueError("Glyph bitmap must have 8 rows") # rows of 5 pixels, top row first, LS bit rightmost
+        code = ord(key)
+        if code < 16 or code > 255:
+            raise ValueError("Glyph key must have a code in range 16-255")
+        self.glyphs[code] = bytes(bitmap)
+        for ctrl in self.controllers:
+            slot = ctrl.cgmap.get(code)
+            if slot is not None:                            # Resident: force an upload of the new bitmap
+                del ctrl.cgmap[code]
+                ctrl.cgkey[slot] = None
+                ctrl.cgtime[slot] = 0
+                for row in ctrl.rows:                       # Cells showing it will be redrawn
+                    self.dirty[row] = True
+
+    def cgslot(self, ctrl, code):                           # Return the CGRAM slot holding a glyph, queueing an
+        self.cgclock += 1                                   # upload if it isn't resident
+        slot = ctrl.cgmap.get(code)
+        if slot is None:
+            slot = 0                                        # Choose a victim: LRU of the slots not on screen, or
+            for idx in range(1, LCD.CGSLOTS):               # LRU overall if all are displayed
+                unused = ctrl.cgrefs[idx] == 0
+                if unused != (ctrl.cgrefs[slot] == 0):
+                    if unused:
+                        slot = idx
+                elif ctrl.cgtime[idx] < ctrl.cgtime[slot]:
+                    slot = idx
+            oldkey = ctrl.cgkey[slot]
+            if oldkey is not None:
+                del ctrl.cgmap[oldkey]
+            ctrl.cgkey[slot] = code
+            ctrl.cgmap[code] = slot
+            self.queue(ctrl, 0x40 | (slot << 3), LCD.CMD)   # Set CGRAM address
+            for bits in self.glyphs[code]:
+                self.queue(ctrl, bits, LCD.CHR)
+            ctrl.cursor = None                              # Address counter now points into CGRAM
+            self.uploads += 1
+            if ctrl.cgrefs[slot]:                           # Cells displaying the evicted glyph now show the new
+                for row in ctrl.rows:                       # one: have them redrawn
+                    self.dirty[row] = True
+        ctrl.cgtime[slot] = self.cgclock
+        return slot
+
+    def __setitem__(self, line, message):                   # Send string to a display line
                                                             # Strip or pad to width of display. Should use "{0:{1}.{1}}".format("rats", 20)
         message = "%-*.*s" % (self.cols,self.cols,message)  # but micropython doesn't work with computed format field sizes
         if message != self.lines[line]:                     # Only update LCD if data has changed
             self.lines[line] = message                      # Update stored line
+            fb = self.fb[line]
+            for col in range(self.cols):
+                code = ord(message[col]) & 0xff
+                fb[col] = code if code >= 16 else 0x20      # Codes 0-15 would display CGRAM directly
             self.dirty[line] = True                         # Flag its non-correspondence with the LCD device
 
     def __getitem__(self, line):
@@ -109,16 +345,36 @@ class LCD(object):                                          # LCD objects appear
 
 def runlcd(thislcd):                                        # Periodically check for changed text and update LCD if so
     wf = Timeout(0.02)
+    wfshed = Timeout(LCD.SHEDPERIOD)
     rr = Roundrobin()
+    controllers = thislcd.controllers
+    nctrl = len(controllers)
     while(True):
-        for row in range(thislcd.rows):
-            if thislcd.dirty[row]:
-                msg = thislcd[row]
-                thislcd.lcd_byte(LCD.LCD_LINES[row], LCD.CMD)
-                for thisbyte in msg:
-                    thislcd.lcd_byte(ord(thisbyte), LCD.CHR)
-                    yield rr                                # Reshedule ASAP
-                thislcd.dirty[row] = False
-        yield wf()                                          # Give other threads a look-in
-
-
+        tstart = pyb.micros()                               # Start of current burst
+        for ctrl in controllers:                            # Start a scan of each controller's rows
+            ctrl.scanrow = 0
+            ctrl.scancol = 0
+        active = nctrl
+        while active:                                       # Until every controller's scan is complete
+            active = 0
+            waiting = 0
+            idx = 0
+            while idx < nctrl:                              # Send one byte to each controller in turn
+                ctrl = controllers[idx]
+                idx += 1
+                if ctrl.opos == ctrl.olen and not thislcd.refill(ctrl):
+                    continue                                # Nothing more to send to this controller
+                active += 1
+                thislcd.select(ctrl)
+                if thislcd.busy():                          # Controller is executing the last instruction
+                    waiting += 1
+                    continue
+                thislcd.lcd_byte(ctrl.obuf[ctrl.opos], ctrl.omode[ctrl.opos])
+                ctrl.opos += 1
+            elapsed = microsSince(tstart)
+            if active and (waiting == active or elapsed + active*thislcd.byte_uS > thislcd.budget): # All controllers
+                thislcd.maxslice_uS = max(thislcd.maxslice_uS, elapsed) # busy or another round won't fit the budget:
+                yield rr                                    # let other threads run
+                tstart = pyb.micros()
+        thislcd.maxslice_uS = max(thislcd.maxslice_uS, microsSince(tstart))
+        yield wfshed() if thislcd.shedding else wf()        # Give other threads a look-in
@@ -0,0 +1,56 @@
+# offload.py Runs blocking calls in a thread or process pool on behalf of usched threads. Host (CPython) only.
+# Author: Peter Hinch
+
+# A usched thread runs until it yields, so a slow operation such as writing a file, computing a checksum or
+# compressing data stalls every other thread. On a host the operation can instead be submitted to a
+# concurrent.futures ThreadPoolExecutor or ProcessPoolExecutor. The thread yields an Offload instance and is
+# rescheduled when the result is ready: meanwhile other threads run as normal.
+# Completion is signalled in the same way as a pin interrupt: the future's done callback, which runs in another OS
+# thread, increments the interrupt count. The scheduler doesn't poll the future. The callback also calls the
+# scheduler's wake_threadsafe method so that a scheduler which sleeps when idle (such as AsyncSched) is woken.
+# The thread receives (1, 0, 0) on completion or (0, 0, uS late) if an optional timeout elapsed first.
+# The offload generator wraps this and returns the result, raising any exception raised by the callable:
+# result = yield from offload(objSched, executor, zlib.compress, (data,))
+# With a ProcessPoolExecutor the callable and its arguments must be picklable.
+
+import threading
+import concurrent.futures
+from usched import Waitfor
+
+class Offload(Waitfor):
+    def __init__(self, objSched, executor, func, func_args = (), timeout = None):
+        super().__init__()
+        self.objSched = objSched
+        self.irq = self                                     # Stands in for a pyb.ExtInt instance
+        self.lock = threading.Lock()
+        if timeout is None:
+            self.forever = True
+        else:
+            self.setdelay(timeout)
+        self.future = executor.submit(func, *func_args)
+        self.future.add_done_callback(self._done)           # Runs immediately if the call has already completed
+
+    def _done(self, future):                                # Runs in an executor thread
+        with self.lock:
+            self.intcallback(0)
+        self.objSched.wake_threadsafe()
+
+    def disable(self):                                      # ExtInt interface used by Waitfor.triggered to protect
+        self.lock.acquire()                                 # the interrupt count
+
+    def enable(self):
+        self.lock.release()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):                                       # Result of the call. Raises its exception if it failed
+        return self.future.result(0)
+
+def offload(objSched, executor, func, func_args = (), timeout = None): # Generator for use in a usched thread: returns
+    wf = Offload(objSched, executor, func, func_args, timeout) # the result of func(*func_args). On timeout the call is
+    yield wf                                                # cancelled if it hasn't started and
+    if not wf.done():                                       # concurrent.futures.TimeoutError is raised
+        wf.future.cancel()
+        raise concurrent.futures.TimeoutError()
+    return wf.result()
@@ -0,0 +1,241 @@
+# shard.py Runs usched threads on several schedulers in separate OS processes or threads. Host (CPython) only.
+# Author: Peter Hinch
+
+# A single Sched runs all its threads on one core. ShardedSched runs N Sched instances ("shards"), each in its own OS
+# process. Alternatively shards can run in OS threads: this only gives parallel execution on a free-threaded
+# (no GIL) build of Python, but avoids the cost of pickling.
+# Threads are added as a generator function and its arguments rather than as a generator object, because the
+# generator must be created in the shard which runs it. In process mode the function must be defined at module level
+# and its arguments must be picklable. A placement policy chooses the shard for each new thread: it's called as
+# policy(loads, func, args) where loads is a list holding the number of threads on each shard, and returns a shard
+# number. roundrobin_policy and leastloaded_policy are provided.
+# Channels created with ShardedSched.channel() carry data between threads on any shards. A thread blocks on a
+# channel with item = yield from chan.get(). Each shard has a wake pipe: put() writes a byte to every shard's pipe
+# and get() blocks on an IOWait on its own shard's pipe, so a shard whose threads are all blocked sleeps in its
+# scheduler's poll call until an item is put or a timeout is due. A woken get() drains the pipe and checks its channel.
+# In process mode an item reaches a multiprocessing queue's pipe via a feeder thread and may arrive after the wake
+# byte: a get() woken to find its channel empty rechecks it after RETRYMIN, doubling the interval up to RETRYPERIOD.
+# Threads and channels must be created before run() is called. run() returns when the threads on every shard have
+# terminated or stop() has been called. A thread may stop all shards by calling stop() on a channel-like StopSignal
+# passed to it as an argument: see ShardedSched.stopsignal().
+# Channels and the StopSignal are keyed by the id of the ShardedSched which created them, so several instances may
+# exist in a process.
+# Each shard's Sched runs with profiling enabled. After run() returns, stats() gives the profiling totals for each
+# shard and in aggregate.
+# If a thread raises an exception, or a shard's process dies, the remaining shards are stopped and run() raises
+# ShardError describing the failure.
+
+import os
+import pickle
+import queue
+import select
+import threading
+import traceback
+import multiprocessing
+from usched import Sched, IOWait, Timeout, PROF_NAMES, PROF_RUN, seconds, microsWhen, microsUntil, after
+
+CONTROLPERIOD = 0.01                                        # Interval at which shards check for a stop request (secs)
+CHECKPERIOD = 0.5                                           # Interval at which run() checks that shards are alive (secs)
+RETRYMIN = 0.001                                            # Intervals at which a blocked get() rechecks its channel
+RETRYPERIOD = 0.1                                           # (secs)
+
+_channels = {}                                              # Channels and StopSignals indexed by (instance id, channel
+_nextsid = 0                                                # id or 'stop'): rebuilt in each process
+_shard = threading.local()                                  # Scheduler and wake pipes of the shard running in this thread
+
+class ShardError(Exception):                                # A shard failed
+    pass
+
+def roundrobin_policy(loads, func, args):                   # Place threads on shards in turn
+    return sum(loads) % len(loads)
+
+def leastloaded_policy(loads, func, args):                  # Place a thread on the shard with fewest threads
+    return loads.index(min(loads))
+
+def _channel(key):                                          # Unpickle a channel: look it up in this process
+    return _channels[key]
+
+class Channel(object):                                      # FIFO carrying items between shards
+    def __init__(self, key, q):
+        self.key = key
+        self.queue = q
+        _channels[key] = self
+
+    def __reduce__(self):                                   # Pickles as a reference to the process's own instance
+        return (_channel, (self.key,))
+
+    def put(self, item):                                    # Never blocks
+        self.queue.put(item)
+        wakers = getattr(_shard, 'wakers', None)            # None if not called from a shard: before run() no shard
+        if wakers is not None:                              # can be blocked
+            for fd in wakers:
+                try:
+                    os.write(fd, b'\0')
+                except BlockingIOError:                     # Pipe is full so a wake is already pending
+                    pass
+
+    def get(self, timeout = None):                          # Generator: item = yield from chan.get(). On timeout
+        deadline = None if timeout is None else microsWhen(seconds(timeout)) # returns None
+        retry = RETRYPERIOD
+        while True:
+            if not self.queue.empty():                      # In process mode avoids taking the lock
+                try:
+                    return self.queue.get_nowait()
+                except queue.Empty:                         # Another thread got the item
+                    pass
+            delay = retry
+            if deadline is not None:
+                if after(deadline):
+                    return None
+                delay = min(delay, microsUntil(deadline)/1000000)
+            result = yield IOWait(_shard.sched, _shard.wakefd, select.POLLIN, delay)
+            try:                                            # Drain the wake pipe before checking the channel: a put
+                os.read(_shard.wakefd, 256)                 # after this leaves a byte for the next wait
+            except BlockingIOError:
+                pass
+            retry = RETRYMIN if result[0] else min(2*retry, RETRYPERIOD) # Woken: the item may be in transit
+
+class StopSignal(object):                                   # Enables a thread to stop every shard
+    def __init__(self, key, event):
+        self.key = key
+        self.event = event
+        _channels[key] = self
+
+    def __reduce__(self):
+        return (_channel, (self.key,))
+
+    def stop(self):
+        self.event.set()
+
+    def is_set(self):
+        return self.event.is_set()
+
+def _control(objSched, stopsignal):                         # Thread run on each shard: stops the shard when a stop is
+    wf = Timeout(CONTROLPERIOD)                             # requested and terminates when it's the only thread left
+    yield wf()                                              # Now on the thread list
+    while sum(1 for thread in objSched.lstThread if thread[1] is not None) > 1:
+        if stopsignal.is_set():
+            objSched.stop()
+        yield wf()
+
+# Shard entry point. specs is a list of (func, args): in process mode it's pickled so that channels can be unpickled
+# once they exist in this process. wakepipe is the reading end of this shard's wake pipe, wakers the writing ends of
+# every shard's.
+def _runshard(shardno, sid, specs, queues, event, results, wakepipe, wakers):
+    try:
+        for cid, q in enumerate(queues):
+            if (sid, cid) not in _channels:                 # Process mode: rebuild the channels in this process
+                Channel((sid, cid), q)
+        stopsignal = _channels.get((sid, 'stop'))
+        if stopsignal is None:
+            stopsignal = StopSignal((sid, 'stop'), event)
+        if isinstance(specs, bytes):
+            specs = pickle.loads(specs)
+        objSched = Sched()
+        objSched.profile_enable()
+        objSched._ioinit()                                  # Sleep in poll rather than spin while threads wait
+        _shard.sched = objSched                             # Context for Channel.get() and put()
+        _shard.pipes = (wakepipe, wakers)                   # Keep the Connections alive: they own the descriptors
+        _shard.wakefd = wakepipe.fileno()
+        _shard.wakers = [waker.fileno() for waker in wakers]
+        os.set_blocking(_shard.wakefd, False)
+        for fd in _shard.wakers:
+            os.set_blocking(fd, False)
+        for func, args in specs:
+            objSched.add_thread(func(*args))
+        objSched.add_thread(_control(objSched, stopsignal)) # Must be the last thread added
+        objSched.run()
+    except Exception:                                       # Stop the other shards and report the failure: the
+        event.set()                                         # exception itself may not be picklable
+        results.put((shardno, 0, 0, None, traceback.format_exc()))
+        return
+    results.put((shardno, len(specs), objSched.profpasses, list(objSched.proftime), None))
+
+class ShardedSched(object):
+    def __init__(self, nshards, policy = roundrobin_policy, processes = True):
+        global _nextsid
+        self.sid = _nextsid                                 # Instance id: distinguishes this instance's channels
+        _nextsid += 1
+        self.nshards = nshards
+        self.policy = policy
+        self.processes = processes
+        self.mp = multiprocessing.get_context()
+        self.specs = [[] for n in range(nshards)]           # (func, args) of threads on each shard
+        self.queues = []                                    # Channel queues indexed by channel id
+        self.event = self.mp.Event() if processes else threading.Event()
+        self.signal = StopSignal((self.sid, 'stop'), self.event)
+        self.results = []                                   # (shard, threads, passes, phase times) for each shard
+        self.errors = []                                    # (shard, traceback) for each shard which failed
+
+    def add_thread(self, func, args = ()):                  # Place a thread on a shard. Returns the shard number
+        shard = self.policy([len(spec) for spec in self.specs], func, args)
+        self.specs[shard].append((func, args))
+        return shard
+
+    def channel(self):                                      # Create a channel
+        q = self.mp.Queue() if self.processes else queue.Queue()
+        self.queues.append(q)
+        return Channel((self.sid, len(self.queues) - 1), q)
+
+    def stopsignal(self):                                   # Object whose stop() method stops all shards
+        return self.signal
+
+    def stop(self):
+        self.event.set()
+
+    def run(self):
+        results = self.mp.Queue() if self.processes else queue.Queue()
+        pipes = [self.mp.Pipe(duplex = False) for shard in range(self.nshards)] # (reader, writer) wake pipe of each shard
+        wakers = [writer for reader, writer in pipes]
+        workers = []
+        for shard in range(self.nshards):
+            if self.processes:
+                args = (shard, self.sid, pickle.dumps(self.specs[shard]), self.queues, self.event, results,
+                        pipes[shard][0], wakers)
+                worker = self.mp.Process(target = _runshard, args = args)
+            else:
+                args = (shard, self.sid, self.specs[shard], self.queues, self.event, results, pipes[shard][0], wakers)
+                worker = threading.Thread(target = _runshard, args = args)
+            worker.start()
+            workers.append(worker)
+        self.results = []                                   # Collect results before join: a process can't exit with
+        self.errors = []                                    # queued data
+        pending = set(range(self.nshards))
+        dead = set()                                        # Shards found dead with no result
+        while pending:
+            try:
+                shard, threads, passes, proftime, error = results.get(timeout = CHECKPERIOD)
+            except queue.Empty:                             # A shard which exited without reporting has failed, but
+                for shard in pending & dead:                # allow a further period for a result it sent just before
+                    self.errors.append((shard, 'exited without a result')) # exiting to arrive
+                    pending.discard(shard)
+                    self.event.set()                        # Stop the other shards
+                dead = {shard for shard in pending if not workers[shard].is_alive()}
+                continue
+            pending.discard(shard)
+            if error is None:
+                self.results.append((shard, threads, passes, proftime))
+            else:
+                self.errors.append((shard, error))
+        for worker in workers:
+            worker.join()
+        for reader, writer in pipes:
+            reader.close()
+            writer.close()
+        self.results.sort()
+        if self.errors:
+            self.errors.sort()
+            raise ShardError('\n'.join('Shard {}: {}'.format(shard, error) for shard, error in self.errors))
+
+    def stats(self):                                        # Return a dict of per shard stats and aggregate totals
+        shards = []
+        for shard, threads, passes, proftime in self.results:
+            shards.append({'shard' : shard, 'threads' : threads, 'passes' : passes,
+                           'phases' : dict(zip(PROF_NAMES, proftime))})
+        total = [sum(result[3][phase] for result in self.results) for phase in range(len(PROF_NAMES))]
+        alltime = sum(total)
+        return {'shards' : shards,
+                'threads' : sum(result[1] for result in self.results),
+                'passes' : sum(result[2] for result in self.results),
+                'phases' : dict(zip(PROF_NAMES, total)),
+                'overhead' : (alltime - total[PROF_RUN])/alltime if alltime else 0.0}
@@ -8,9 +8,30 @@
 # and sending the result to the yield statement
 # New implementation. Uses microsecond counter more effectively. Supports waiting on interrupt.
 
-import pyb
-import micropython
-micropython.alloc_emergency_exception_buf(100)
+import array
+import sys
+try:
+    import select
+except ImportError:
+    try:
+        import uselect as select
+    except ImportError:                                     # IOWait is unavailable
+        select = None
+try:
+    import os
+    os.pipe                                                 # Needed for wake_threadsafe to interrupt an idle poll
+except (ImportError, AttributeError):
+    os = None
+try:
+    import pyb
+    import micropython
+    micropython.alloc_emergency_exception_buf(100)
+    micros = pyb.micros
+except ImportError:                                         # Running on a host (e.g. Linux) under CPython. There are no
+    import time                                             # pin interrupts: Pinblock can't be used
+    pyb = None
+    def micros():
+        return int(time.monotonic()*1000000) & TIMERPERIOD
 
 # *************************************************** TIMER ACCESS **************************************************
 
@@ -25,19 +46,19 @@ class TimerException(Exception) : pass
 def microsWhen(timediff):                                   # Expected value of counter in a given no. of uS
     if timediff >= MAXTIME:
         raise TimerException()
-    return (pyb.micros() + timediff) & TIMERPERIOD
+    return (micros() + timediff) & TIMERPERIOD
 
 def microsSince(oldtime):                                   # No of uS since timer held this value
-    return (pyb.micros() - oldtime) & TIMERPERIOD
+    return (micros() - oldtime) & TIMERPERIOD
 
 def after(trigtime):                                        # If current time is after the specified value return
-    res = ((pyb.micros() - trigtime) & TIMERPERIOD)         # the no. of uS after. Otherwise return zero
+    res = ((micros() - trigtime) & TIMERPERIOD)             # the no. of uS after. Otherwise return zero
     if res >= MAXTIME:
         res = 0
     return res
 
 def microsUntil(tim):                                       # uS from now until a specified time (used in Delay class)
-    return ((tim - pyb.micros()) & TIMERPERIOD)
+    return ((tim - micros()) & TIMERPERIOD)
 
 def seconds(S):                                             # Utility functions to convert to integer microseconds
     return int(1000000*S)
@@ -78,6 +99,9 @@ class Waitfor(object):
         self.customcallback = None                          # Optional custom interrupt handler
         self.interruptcount = 0                             # Set by handler, tested by triggered()
         self.roundrobin = False                             # If true reschedule ASAP
+        self.sheddable  = False                             # If true the scheduler may throttle the poll function
+        self.pollskip   = 1                                 # Poll function is called on every pollskip'th check
+        self.pollcount  = 0
 
     def triggered(self):                                    # Polled by scheduler. Returns a priority tuple or None if not ready
         if self.irq:                                        # Waiting on an interrupt
@@ -89,7 +113,15 @@ class Waitfor(object):
             if numints:
                 return (numints, 0, 0)
         if self.pollfunc:                                   # Optional function for the scheduler to poll
-            res = self.pollfunc(*self.pollfunc_args)        # something other than an interrupt
+            if self.pollskip > 1:                           # something other than an interrupt. Throttled because
+                self.pollcount += 1                         # the scheduler is overloaded: skip some calls
+                if self.pollcount < self.pollskip:
+                    res = None
+                else:
+                    self.pollcount = 0
+                    res = self.pollfunc(*self.pollfunc_args)
+            else:
+                res = self.pollfunc(*self.pollfunc_args)
             if res is not None:
                 return (0, res, 0)
         if not self.forever:                                # Check for timeout
@@ -164,31 +196,320 @@ class Pinblock(Waitfor):                                    # Block on an interr
             self.setdelay(timeout)
         self.irq = pyb.ExtInt(pin, mode, pull, self.intcallback)
 
-class Poller(Waitfor):
-    def __init__(self, pollfunc, pollfunc_args = (), timeout = None):
+class Poller(Waitfor):                                      # Unless shed is False the poll function is called less
+    def __init__(self, pollfunc, pollfunc_args = (), timeout = None, shed = True): # often while overloaded
         super().__init__()
         self.pollfunc   = pollfunc
         self.pollfunc_args = pollfunc_args
+        self.sheddable  = shed
         if timeout is None:
             self.forever = True
         else:
             self.setdelay(timeout)
 
+# ************************************************** STREAM I/O ****************************************************
+
+# A thread can block until a file descriptor or stream is ready for I/O: a serial port or socket for example.
+# wf = IOWait(objSched, stream, select.POLLIN, timeout)
+# While a thread is blocked on it the stream is registered with a select.poll object owned by the scheduler. The
+# scheduler polls it once per pass with a zero timeout rather than calling a poll function for each stream, so many
+# connections cost one system call. When there are no threads ready to run the scheduler sleeps in the poll call until
+# the next timeout is due or a stream becomes ready. On readiness the thread receives (1, 0, 0): revents holds the poll
+# events. It receives (0, 0, uS late) on timeout.
+# A stream is registered only while a thread is blocked on an IOWait for it: when the IOWait is ready or times out it's
+# unregistered, and it's registered again when the thread next yields it. So a stream with unread data doesn't wake the
+# scheduler while its thread is doing something else. Several IOWait instances may refer to the same stream, for
+# example one thread waiting on POLLIN and another on POLLOUT: the stream is registered for the union of the events.
+# close() unregisters the stream if a thread is blocked on the IOWait.
+# A scheduler has no way of sleeping pending a pin interrupt, so it doesn't sleep while any thread waits on a Pinblock.
+# AsyncSched (asyncbridge.py) doesn't sleep in poll: under asyncio use its Readable class instead.
+
+class IOWait(Waitfor):
+    def __init__(self, objSched, stream, eventmask = None, timeout = None):
+        super().__init__()
+        self.objSched = objSched
+        self.stream = stream
+        self.eventmask = select.POLLIN if eventmask is None else eventmask
+        self.revents = 0                                    # Events returned by poll
+        self.irq = self                                     # Readiness is handled like an interrupt
+        self.armed = False                                  # True while registered with the scheduler's poll object
+        if timeout is None:
+            self.forever = True
+        else:
+            self.setdelay(timeout)
+        objSched._ioinit()
+
+    def triggered(self):                                    # Register while blocked, unregister when the thread is to
+        res = super().triggered()                           # run: readiness is then stale until it next yields this
+        if res is None:
+            if not self.armed:
+                self.objSched._ioregister(self)
+        elif self.armed:
+            self.objSched._iounregister(self)
+        return res
+
+    def key(self):                                          # The value poll() returns for this stream
+        if self.objSched.iobyfd and hasattr(self.stream, 'fileno'):
+            return self.stream.fileno()
+        return self.stream
+
+    def disable(self):                                      # ExtInt interface used by Waitfor.triggered. Readiness is
+        pass                                                # recorded in the scheduler's thread
+
+    def enable(self):
+        pass
+
+    def close(self):
+        if self.armed:
+            self.objSched._iounregister(self)
+
 # ************************************************* SCHEDULER CLASS *************************************************
 
+# Profiling:
+# profile_enable() causes the scheduler to measure where the time goes in each pass of its loop. A pass starts by
+# removing terminated threads from the list then repeatedly polls the threads' Waitfor objects, sorts those ready to
+# run by priority and runs them. Time is charged to one of these phases:
+PROF_REBUILD    = 0                                         # Removing terminated threads from the thread list
+PROF_POLL       = 1                                         # Calling triggered() methods: includes poll functions
+PROF_SORT       = 2                                         # Sorting the priority list
+PROF_RUN        = 3                                         # Running threads: the useful work
+PROF_NAMES      = ('rebuild', 'poll', 'sort', 'run')
+PROF_BUCKETS    = 20                                        # Histogram bucket n counts passes taking < 2**n uS
+# Totals for each phase are held in proftime and the number of passes in profpasses. profhist holds a histogram for
+# each phase of the time spent in it per pass. profile_overhead() returns the fraction of time spent in phases other
+# than running threads and profile_report() prints a summary. Profiling costs a call to micros() per phase and
+# will itself inflate the overhead a little: the figures are best used for comparison.
+
+# Tracing:
+# trace_enable(n) allocates a ring buffer holding the n most recent thread executions. Each record is four integers:
+# thread id (as returned by add_thread), wake reason, and the values of micros() when the thread was resumed and
+# when it yielded. Recording doesn't allocate and costs two calls to micros() and a few stores per execution.
+# Wake reasons are derived from the priority tuple sent to the thread:
+TRACE_RR        = 0                                         # Round robin
+TRACE_IRQ       = 1                                         # Interrupt
+TRACE_POLL      = 2                                         # Poll function
+TRACE_TIMEOUT   = 3                                         # Timeout
+# trace_dump() prints the records, oldest first, in a form which trace2chrome.py can convert on a host PC to Chrome
+# trace-event JSON for viewing in Perfetto (https://ui.perfetto.dev) or chrome://tracing.
+
+# Fair share:
+# By default each round robin thread runs once per pass regardless of how long it runs before yielding, so a thread
+# which runs for 50uS gets no more turns than one which runs for 5mS. fairshare_enable() measures the time each thread
+# spends in send() and accumulates a virtual runtime: the time divided by the thread's weight (default 1, set by
+# add_thread or set_weight). Virtual runtime is held in units of 1/WEIGHTSCALE uS so that short slices of heavily
+# weighted threads aren't lost to integer division. In each pass only round robin threads whose virtual runtime is
+# within FAIRGRAIN uS of the lowest are run, lowest first. A thread which has run for longer than its share therefore
+# sits out passes while the others catch up. A thread which has been blocked has its virtual runtime raised to no less
+# than FAIRGRAIN below the scheduler's minimum so that on waking it can't monopolise the CPU. Higher priority threads
+# are unaffected.
+# Virtual runtimes are rebased to zero when the lowest exceeds FAIRREBASE and the charge for a single execution is
+# limited to FAIRMAXRUN uS, so that values stay well within MicroPython's small integer range and don't allocate.
+FAIRGRAIN       = 2000                                      # uS
+WEIGHTSCALE     = 1024                                      # Virtual runtime units per uS at weight 1
+FAIRREBASE      = MAXTIME >> 2                              # Virtual runtime units
+FAIRMAXRUN      = FAIRREBASE // WEIGHTSCALE                 # uS (262mS)
+
+# Overload detection:
+# When the scheduler can't keep up, threads waiting on timeouts run progressively later: element 2 of the tuple sent to
+# them grows. The scheduler maintains lag, an exponentially weighted moving average of the greatest lateness of any
+# timed out thread in each pass (uS). Passes which run no timed out thread don't update it. overload_enable(high, low)
+# enables detection: when lag exceeds high seconds the scheduler enters the overloaded state, leaving it when lag falls
+# below low. On each change of state handlers registered with add_shed_handler(func, args) are called as
+# func(overloaded, *args).
+# While overloaded Poller instances call their poll functions only on every SHEDSKIP'th check (unless created with
+# shed = False) and LCD instances (lcdthread.py) refresh less often.
+LAGSHIFT        = 3                                         # EWMA weight of each new sample is 1/2**LAGSHIFT
+SHEDSKIP        = 4
+
 class Sched(object):
     def __init__(self):
-        self.lstThread = []                                 # Entries contain [Waitfor object, function]
+        self.lstThread = []                                 # Entries contain [Waitfor object, function, thread id,
+                                                            # virtual runtime, weight]
         self.bStop = False
+        self.nextid = 0                                     # Thread id of next thread to be added
+        self.tracebuf = None                                # Trace ring buffer: None if not tracing
+        self.tracelen = 0                                   # Capacity in records
+        self.traceidx = 0                                   # Index of next record to be written
+        self.tracecount = 0                                 # Total no. of records written
+        self.profpass = None                                # Profiling: time in each phase this pass. None if off
+        self.proftime = None                                # Total time in each phase
+        self.profhist = None                                # Histogram of per pass time for each phase
+        self.profpasses = 0
+        self.poller = None                                  # select.poll object: created when first needed
+        self.iobyfd = False                                 # True if poll() returns file descriptors
+        self.iowaits = {}                                   # Lists of registered IOWait instances indexed by fd or stream
+        self.iopolled = False                               # True if an idle poll has just been done
+        self.wakefds = None                                 # Pipe used by wake_threadsafe to end an idle poll
+        self.fairshare = False
+        self.minvruntime = 0                                # Lowest virtual runtime of runnable round robin threads
+        self.lag = 0                                        # Smoothed lateness of timed out threads (uS)
+        self.lagmax = 0                                     # Peak value of lag
+        self.lagthresholds = None                           # (high, low) in uS: None if overload detection is off
+        self.overloaded = False
+        self.shedhandlers = []                              # [func, args] called on change of overload state
+        self.pollskip = 1                                   # Applied to sheddable Pollers
 
     def stop(self):                                         # Kill the run method
         self.bStop = True
 
-    def add_thread(self, func):                             # Thread list contains [Waitfor object, generator]
+    def add_thread(self, func, weight = 1):                 # Thread list contains [Waitfor object, generator, id,
+        if weight < 1:                                      # virtual runtime, weight]. Returns the thread id
+            raise ValueError("Weight must be at least 1")
+        tid = self.nextid
+        self.nextid += 1
         try:                                                # Run thread to first yield to acquire a Waitfor instance
-            self.lstThread.append([func.send(None), func])  # and put the resultant thread onto the threadlist
+            self.lstThread.append([func.send(None), func, tid, self.minvruntime, weight]) # and put the resultant thread onto the threadlist
         except StopIteration:                               # Shouldn't happen on 1st call: implies thread lacks a yield statement
             print("Stop iteration error")                   # best to tell user.
+        return tid
+
+    def set_weight(self, tid, weight):                      # Set a thread's fair share weight
+        if weight < 1:
+            raise ValueError("Weight must be at least 1")
+        for thread in self.lstThread:
+            if thread[2] == tid:
+                thread[4] = weight
+
+    def overload_enable(self, high, low = None):            # Detect overload: thresholds in secs. low defaults to
+        if low is None:                                     # half of high
+            low = high/2
+        self.lagthresholds = (seconds(high), seconds(low))
+
+    def overload_disable(self):
+        self.lagthresholds = None
+        self._setoverload(False)
+
+    def add_shed_handler(self, func, args = ()):            # Register func(overloaded, *args) to be called on change of
+        self.shedhandlers.append([func, args])              # overload state
+
+    def _setoverload(self, overloaded):
+        if overloaded == self.overloaded:
+            return
+        self.overloaded = overloaded
+        self.pollskip = SHEDSKIP if overloaded else 1
+        for thread in self.lstThread:                       # Throttle or restore Pollers threads are waiting on
+            if thread[0].sheddable:
+                thread[0].pollskip = self.pollskip
+        for func, args in self.shedhandlers:
+            func(overloaded, *args)
+
+    def _updatelag(self, passlag):                          # Called at the end of a pass with the greatest lateness of
+        self.lag += (passlag - self.lag) >> LAGSHIFT        # any timed out thread run
+        if self.lag > self.lagmax:
+            self.lagmax = self.lag
+        thresholds = self.lagthresholds
+        if thresholds is not None:
+            if self.lag > thresholds[0]:
+                self._setoverload(True)
+            elif self.lag < thresholds[1]:
+                self._setoverload(False)
+
+    def fairshare_enable(self):                             # Dispatch round robin threads by weighted virtual runtime
+        self.fairshare = True
+
+    def fairshare_disable(self):
+        self.fairshare = False
+
+    def trace_enable(self, records):                        # Start tracing into a ring of the given no. of records
+        self.tracebuf = array.array('I', [0]*(4*records))
+        self.tracelen = records
+        self.traceidx = 0
+        self.tracecount = 0
+
+    def trace_disable(self):
+        self.tracebuf = None
+
+    def trace_dump(self):                                   # Print the trace, oldest record first
+        buf = self.tracebuf
+        if buf is None:
+            return
+        n = min(self.tracecount, self.tracelen)
+        print("usched trace {:d} records {:d} lost".format(n, self.tracecount - n))
+        idx = (self.traceidx - n) % self.tracelen
+        while n:
+            base = 4*idx
+            print("{:d} {:d} {:d} {:d}".format(buf[base], buf[base + 1], buf[base + 2], buf[base + 3]))
+            idx = (idx + 1) % self.tracelen
+            n -= 1
+        print("end")
+
+    def profile_enable(self):                               # Start profiling, zeroing the counters
+        self.profpass = [0]*len(PROF_NAMES)
+        self.proftime = [0]*len(PROF_NAMES)
+        self.profhist = [array.array('I', [0]*PROF_BUCKETS) for phase in PROF_NAMES]
+        self.profpasses = 0
+
+    def profile_disable(self):                              # Stop profiling. Counters are retained
+        self.profpass = None
+
+    def profile_overhead(self):                             # Fraction of time spent on scheduling rather than threads
+        total = sum(self.proftime) if self.proftime else 0
+        if total == 0:
+            return 0.0
+        return (total - self.proftime[PROF_RUN])/total
+
+    def profile_report(self):
+        if not self.proftime:
+            return
+        total = max(sum(self.proftime), 1)
+        print("{:d} passes {:d} threads overhead {:5.1f}%".format(self.profpasses, len(self.lstThread),
+            100*self.profile_overhead()))
+        for phase, name in enumerate(PROF_NAMES):
+            hist = self.profhist[phase]
+            top = PROF_BUCKETS
+            while top > 1 and hist[top - 1] == 0:           # Don't print trailing empty buckets
+                top -= 1
+            print("{:8s}{:10d}uS {:5.1f}% per pass uS <1,2,4..: {}".format(name, self.proftime[phase],
+                100*self.proftime[phase]/total, " ".join(str(hist[n]) for n in range(top))))
+
+    def _lap(self, prof, phase, tlap):                      # Charge time since tlap to a phase. Return current time
+        now = micros()
+        prof[phase] += (now - tlap) & TIMERPERIOD
+        return now
+
+    def _endpass(self, prof):                               # Accumulate the pass's phase times and zero them
+        for phase in range(len(prof)):
+            t = prof[phase]
+            self.proftime[phase] += t
+            bucket = 0
+            while t and bucket < PROF_BUCKETS - 1:          # Bucket n holds times < 2**n uS
+                t >>= 1
+                bucket += 1
+            self.profhist[phase][bucket] += 1
+            prof[phase] = 0
+        self.profpasses += 1
+
+    def _runthread(self, idx, priority):                    # Run a thread, sending it (interrupt count, poll func value,
+        thread = self.lstThread[idx]                        # uS overdue). thread[0] is the current waitfor instance,
+        buf = self.tracebuf                                 # thread[1] is the code
+        fair = self.fairshare
+        if buf is not None or fair:
+            start = micros()
+        try:
+            thread[0] = thread[1].send(priority)            # Thread yields a Waitfor object: store it for subsequent testing
+        except StopIteration:                               # The thread has terminated:
+            thread[1] = None                                # Flag thread for removal
+        if thread[0].sheddable:                             # Poller: apply any throttling
+            thread[0].pollskip = self.pollskip
+        if fair:                                            # Charge the run time to the thread
+            thread[3] += min((micros() - start) & TIMERPERIOD, FAIRMAXRUN)*WEIGHTSCALE // thread[4]
+        if buf is not None:                                 # Record the execution
+            base = 4*self.traceidx
+            buf[base] = thread[2]
+            if priority[0]:
+                buf[base + 1] = TRACE_IRQ
+            elif priority[1]:
+                buf[base + 1] = TRACE_POLL
+            elif priority[2]:
+                buf[base + 1] = TRACE_TIMEOUT
+            else:
+                buf[base + 1] = TRACE_RR
+            buf[base + 2] = start
+            buf[base + 3] = micros()
+            self.traceidx += 1
+            if self.traceidx >= self.tracelen:
+                self.traceidx = 0
+            self.tracecount += 1
 
     def run(self):                                          # Run scheduler but trap ^C for testing
         try:
@@ -199,40 +520,180 @@ class Sched(object):
 
     def _runthreads(self):                                  # Only returns if the stop method is used or all threads terminate
         while len(self.lstThread) and not self.bStop:       # Run until last thread terminates or the scheduler is stopped
-            self.lstThread = [thread for thread in self.lstThread if thread[1] is not None] # Remove threads flagged for deletion
-            lstPriority = []                                # List threads which are ready to run
-            lstRoundRobin = []                              # Low priority round robin threads
-            for idx, thread in enumerate(self.lstThread):   # Put each pending thread on priority or round robin list
-                priority = thread[0].triggered()            # (interrupt count, poll func value, uS overdue) or None
-                if priority is not None:                    # Ignore threads waiting on events or time
-                    if priority == (0,0,0) :                # (0,0,0) indicates round robin
-                        lstRoundRobin.append(idx)
-                    else:                                   # Thread is ready to run
-                        lstPriority.append((priority, idx)) # List threads ready to run
-            lstPriority.sort()                              # Lowest priority will be first in list
-
-            while True:                                     # Until there are no round robin threads left
-                while len(lstPriority):                     # Execute high priority threads first
-                    priority, idx = lstPriority.pop(-1)     # Get highest priority thread. Thread:
-                    thread = self.lstThread[idx]            # thread[0] is the current waitfor instance, thread[1] is the code
-                    try:                                    # Run thread, send (interrupt count, poll func value, uS overdue)
-                        thread[0] = thread[1].send(priority)  # Thread yields a Waitfor object: store it for subsequent testing
-                    except StopIteration:                   # The thread has terminated:
-                        self.lstThread[idx][1] = None       # Flag thread for removal
-
-                if len(lstRoundRobin) == 0:                 # There are no round robins pending. Quit the loop to rebuild new
-                    break                                   # lists of threads
-                idx = lstRoundRobin.pop()                   # Run an arbitrary round robin thread and remove from pending list
-                thread = self.lstThread[idx]
-                try:                                        # Run thread, send (0,0,0) because it's a round robin
-                    thread[0] = thread[1].send((0,0,0))     # Thread yields a Waitfor object: store it
-                except StopIteration:                       # The thread has terminated:
-                    self.lstThread[idx][1] = None           # Flag thread for removal
+            self._runpass()
+            if self.poller is not None and not self.bStop:  # Streams are registered: sleep in poll if there's nothing
+                due = self._timetorun()                     # to do
+                if due:
+                    self._iopoll((due + 999)//1000)
+                elif due is None and self.iowaits:          # Only a stream can now wake a thread: threads are blocked
+                                                            # on the registered streams
+                    self._iopoll(-1)
+
+    def wake(self):                                         # Called when an event outside the scheduler's control may
+        pass                                                # have made a thread ready. This scheduler polls continuously
+
+    def wake_threadsafe(self):                              # As wake() but may be called from another OS thread. Ends
+        if self.wakefds is not None:                        # an idle poll
+            os.write(self.wakefds[1], b'\0')
+
+    def _ioinit(self):                                      # Create the poll object when the first IOWait is created
+        if self.poller is None:
+            self.poller = select.poll()                     # CPython's poll() returns file descriptors, MicroPython's
+            self.iobyfd = sys.implementation.name != 'micropython' # returns the registered object
+            if os is not None:
+                self.wakefds = os.pipe()
+                self.poller.register(self.wakefds[0], select.POLLIN)
+
+    def _ioregister(self, wf):                              # A thread is blocked on an IOWait
+        key = wf.key()
+        waits = self.iowaits.get(key)
+        if waits is None:
+            self.iowaits[key] = [wf]
+            self.poller.register(wf.stream, wf.eventmask)
+        else:
+            waits.append(wf)
+            self._iomodify(wf.stream, waits)
+        wf.armed = True
+
+    def _iounregister(self, wf):
+        key = wf.key()
+        waits = self.iowaits[key]
+        waits.remove(wf)
+        if waits:
+            self._iomodify(wf.stream, waits)
+        else:
+            del self.iowaits[key]
+            self.poller.unregister(wf.stream)
+        wf.armed = False
+
+    def _iomodify(self, stream, waits):                     # Register a stream for the events of all its IOWaits
+        eventmask = 0
+        for wf in waits:
+            eventmask |= wf.eventmask
+        self.poller.modify(stream, eventmask)
+
+    def _iopoll(self, timeout):                             # Poll registered streams: timeout in mS, -1 is forever
+        for key, revents in self.poller.poll(timeout):
+            if self.wakefds is not None and key == self.wakefds[0]:
+                os.read(key, 64)                            # Drain wake_threadsafe's data
+                continue
+            waits = self.iowaits.get(key)
+            if waits is None:
+                continue
+            for wf in waits[:]:                             # Errors and hangups are reported to every waiter
+                if revents & (wf.eventmask | select.POLLERR | select.POLLHUP):
+                    wf.revents = revents
+                    wf.intcallback(key)
+                    self._iounregister(wf)                  # Until the thread next blocks on it
+        self.iopolled = timeout != 0
+
+    def _timetorun(self, pollwait = 0):                     # uS until a thread is due to run: 0 if one may be ready now,
+        due = None                                          # None if all are waiting on events. Threads waiting on a poll
+        for thread in self.lstThread:                       # function are deemed due in pollwait uS
+            if thread[1] is None:
+                continue
+            wf = thread[0]
+            if wf.roundrobin or wf.interruptcount:
+                return 0
+            if wf.irq is not None and wf.irq is not wf:     # Pin interrupt: can occur at any time
+                return 0
+            if isinstance(wf, IOWait) and not wf.armed:     # Newly yielded: a pass must register its stream before
+                return 0                                    # an idle poll can detect readiness
+            if wf.pollfunc and (due is None or pollwait < due):
+                due = pollwait
+            if not wf.forever:
+                if after(wf.timeout):
+                    return 0
+                tim = microsUntil(wf.timeout)
+                if due is None or tim < due:
+                    due = tim
+        return due
+
+    def _fairselect(self, lstRoundRobin):                   # Reduce the round robin list to the threads whose turn it
+        if len(lstRoundRobin) == 0:                         # is, ordered so that pop() returns the lowest virtual
+            return lstRoundRobin                            # runtime
+        lstThread = self.lstThread
+        grain = FAIRGRAIN*WEIGHTSCALE
+        floor = self.minvruntime - grain                    # Threads which have been blocked can't drop below this
+        least = None
+        for idx in lstRoundRobin:
+            thread = lstThread[idx]
+            if thread[3] < floor:
+                thread[3] = floor
+            if least is None or thread[3] < least:
+                least = thread[3]
+        if least > self.minvruntime:                        # Minimum only moves forward
+            self.minvruntime = least
+        if least > FAIRREBASE:                              # Keep values small: avoids long integers on MicroPython
+            for thread in lstThread:
+                thread[3] = max(thread[3] - least, 0)
+            self.minvruntime -= least
+            least = 0
+        limit = least + grain
+        lstFair = [(lstThread[idx][3], idx) for idx in lstRoundRobin if lstThread[idx][3] <= limit]
+        lstFair.sort(reverse = True)
+        return [idx for vruntime, idx in lstFair]
+
+    def _runpass(self):                                     # One pass: run each ready thread once
+        prof = self.profpass                                # Per pass phase times or None if not profiling
+        if prof is not None:
+            tlap = micros()
+        self.lstThread = [thread for thread in self.lstThread if thread[1] is not None] # Remove threads flagged for deletion
+        if prof is not None:
+            tlap = self._lap(prof, PROF_REBUILD, tlap)
+        if self.poller is not None:                         # One system call checks all registered streams
+            if self.iopolled:                               # unless an idle poll has just done so
+                self.iopolled = False
+            else:
+                self._iopoll(0)
+        lstPriority = []                                    # List threads which are ready to run
+        lstRoundRobin = []                                  # Low priority round robin threads
+        for idx, thread in enumerate(self.lstThread):       # Put each pending thread on priority or round robin list
+            priority = thread[0].triggered()                # (interrupt count, poll func value, uS overdue) or None
+            if priority is not None:                        # Ignore threads waiting on events or time
+                if priority == (0,0,0) :                    # (0,0,0) indicates round robin
+                    lstRoundRobin.append(idx)
+                else:                                       # Thread is ready to run
+                    lstPriority.append((priority, idx))     # List threads ready to run
+        if self.fairshare:
+            lstRoundRobin = self._fairselect(lstRoundRobin)
+        if prof is not None:
+            tlap = self._lap(prof, PROF_POLL, tlap)
+        lstPriority.sort()                                  # Lowest priority will be first in list
+        if prof is not None:
+            tlap = self._lap(prof, PROF_SORT, tlap)
+
+        passlag = 0                                         # Greatest lateness of a timed out thread
+        while True:                                         # Until there are no round robin threads left
+            while len(lstPriority):                         # Execute high priority threads first
+                priority, idx = lstPriority.pop(-1)         # Get highest priority thread.
+                if priority[2] > passlag:
+                    passlag = priority[2]
+                self._runthread(idx, priority)
+            if prof is not None:
+                tlap = self._lap(prof, PROF_RUN, tlap)
+
+            if len(lstRoundRobin) == 0:                     # There are no round robins pending. Quit the loop to rebuild new
+                break                                       # lists of threads
+            idx = lstRoundRobin.pop()                       # Run an arbitrary round robin thread and remove from pending list
+                                                            # In fair share mode it's the one with least virtual runtime
+            self._runthread(idx, (0,0,0))                   # send (0,0,0) because it's a round robin
+            if prof is not None:
+                tlap = self._lap(prof, PROF_RUN, tlap)
                                                             # Rebuild priority list: time has elapsed and events may have occurred!
-                for idx, thread in enumerate(self.lstThread): # check and handle priority threads
-                    priority = thread[0].triggered()        # (interrupt count, poll func value, uS overdue) or None
-                                                            # Ignore pending threads, those scheduled for deletion and round robins
-                    if priority is not None and priority != (0,0,0) and thread[1] is not None:
-                         lstPriority.append((priority, idx)) # Just list threads wanting to run
-                lstPriority.sort()
-
+            for idx, thread in enumerate(self.lstThread):   # check and handle priority threads
+                if thread[1] is None:                       # Scheduled for deletion: don't poll its last Waitfor as
+                    continue                                # a poll function may consume data
+                priority = thread[0].triggered()            # (interrupt count, poll func value, uS overdue) or None
+                                                            # Ignore pending threads and round robins
+                if priority is not None and priority != (0,0,0):
+                     lstPriority.append((priority, idx))    # Just list threads wanting to run
+            if prof is not None:
+                tlap = self._lap(prof, PROF_POLL, tlap)
+            lstPriority.sort()
+            if prof is not None:
+                tlap = self._lap(prof, PROF_SORT, tlap)
+        if passlag:                                         # Passes running no timed out threads carry no information
+            self._updatelag(passlag)                        # about lateness: threads woken by events report zero
+        if prof is not None:
+            self._endpass(prof)
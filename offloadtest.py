@@ -0,0 +1,58 @@
+# offloadtest.py Demo of offloading blocking calls from usched threads to thread and process pools
+# Author: Peter Hinch
+
+# Run on a host PC under CPython, with the lib directory on the path:
+# PYTHONPATH=lib python3 offloadtest.py
+# A ticker thread measures the longest interval between its executions. Worker threads compress data in a thread pool
+# and run a CPU bound function in a process pool. The same work is then done inline for comparison: the ticker's
+# worst case latency shows the effect of stalling the scheduler.
+
+import zlib
+import concurrent.futures
+from usched import Sched, Roundrobin, microsSince, micros
+from offload import offload
+
+DATA = bytes(range(256))*20000
+
+def crunch(n):                                              # CPU bound: must be a module level function for pickling
+    total = 0
+    for x in range(n):
+        total += x*x
+    return total
+
+# THREADS:
+
+def ticker(lstResult):
+    wf = Roundrobin()
+    yield wf()
+    while True:
+        start = micros()
+        yield wf()
+        lstResult[0] = max(lstResult[0], microsSince(start))
+
+def worker(objSched, threadpool, procpool, inline):
+    for x in range(3):
+        if inline:
+            packed = zlib.compress(DATA, 9)
+            total = crunch(2000000)
+        else:
+            packed = yield from offload(objSched, threadpool, zlib.compress, (DATA, 9))
+            total = yield from offload(objSched, procpool, crunch, (2000000,))
+        print("Compressed {:d} bytes to {:d}, crunch = {:d}".format(len(DATA), len(packed), total))
+        yield Roundrobin()
+    objSched.stop()
+
+# USER TEST PROGRAM
+
+def test(inline):
+    lstResult = [0]
+    objSched = Sched()
+    with concurrent.futures.ThreadPoolExecutor(2) as threadpool, concurrent.futures.ProcessPoolExecutor(2) as procpool:
+        objSched.add_thread(ticker(lstResult))
+        objSched.add_thread(worker(objSched, threadpool, procpool, inline))
+        objSched.run()
+    print("{:s}: maximum ticker latency {:6.1f}mS".format("Inline" if inline else "Offloaded", lstResult[0]/1000))
+
+if __name__ == '__main__':
+    test(False)
+    test(True)
@@ -0,0 +1,73 @@
+# overloadtest.py Demo of the scheduler's overload detection and load shedding
+# Author: Peter Hinch
+
+# Runs on the MicroPython board or on a host PC (PYTHONPATH=lib python3 overloadtest.py)
+# A thread runs every 10mS and a Poller polls a counter. After one second a hog thread starts which busy waits for
+# 25mS at a time, so that the periodic thread runs late. Once the smoothed lag exceeds 10mS the scheduler is overloaded
+# and calls the shed handler: the poll function is then called less often. The hog stops after a further second and
+# the lag recovers. The demo prints each change of state and the rate at which the poll function was called.
+
+from usched import Sched, Timeout, Poller, Roundrobin, wait, micros, microsSince
+
+# THREADS:
+
+def stop(fTim, objSch):                                     # Stop the scheduler after fTim seconds
+    yield from wait(fTim)
+    objSch.stop()
+
+def periodic(lstLate):                                      # Runs every 10mS recording the peak lateness
+    wf = Timeout(0.01)
+    while True:
+        result = yield wf()
+        lstLate[0] = max(lstLate[0], result[2])
+
+def counter(lstPolls):                                      # Poll function: count calls. Never ready
+    lstPolls[0] += 1
+    return None
+
+def polled(lstPolls):                                       # Blocks on a Poller which never triggers
+    wf = Poller(counter, (lstPolls,), 0.5)
+    while True:
+        yield wf()
+
+def hog(tStart, tRun):                                      # Busy waits for 25mS at a time
+    yield from wait(tStart)
+    wf = Roundrobin()
+    start = micros()
+    while microsSince(start) < tRun*1000000:
+        t = micros()
+        while microsSince(t) < 25000:
+            pass
+        yield wf()
+
+def monitor(objSch, lstPolls, lstLate):                     # Report every 250mS
+    wf = Timeout(0.25)
+    t = 0
+    while True:
+        lstPolls[0] = 0
+        lstLate[0] = 0
+        yield wf()
+        t += 250
+        print("{:5d}mS lag {:6d}uS peak late {:6d}uS polls {:6d} {}".format(t, objSch.lag, lstLate[0], lstPolls[0],
+              "overloaded" if objSch.overloaded else ""))
+
+def shed(overloaded, objSch):                               # Shed handler
+    print("Overloaded: lag {}uS".format(objSch.lag) if overloaded else "Recovered: lag {}uS".format(objSch.lag))
+
+# USER TEST PROGRAM
+
+def test(duration = 4):
+    objSched = Sched()
+    objSched.overload_enable(0.01, 0.002)                   # Overloaded above 10mS, recovered below 2mS
+    objSched.add_shed_handler(shed, (objSched,))
+    polls = [0]
+    late = [0]
+    objSched.add_thread(periodic(late))
+    objSched.add_thread(polled(polls))
+    objSched.add_thread(hog(1, 1))
+    objSched.add_thread(monitor(objSched, polls, late))
+    objSched.add_thread(stop(duration, objSched))
+    objSched.run()
+    print("Peak lag {}uS".format(objSched.lagmax))
+
+test(4)
@@ -0,0 +1,61 @@
+# proftest.py Uses the scheduler's profiler to show how its overhead varies with thread count and Waitfor type
+# Author: Peter Hinch
+
+from usched import Sched, Roundrobin, Timeout, Poller, wait
+
+# Runs on the MicroPython board or on a host PC (PYTHONPATH=lib python3 proftest.py)
+# For each Waitfor type and thread count a scheduler is run for a period with that many threads, each doing a fixed
+# amount of work per execution. The percentage of time spent in the scheduler rather than in threads is printed.
+
+# THREADS:
+
+def stop(fTim, objSch):                                     # Stop the scheduler after fTim seconds
+    yield from wait(fTim)
+    objSch.stop()
+
+def work():                                                 # Fixed amount of work per execution
+    for x in range(20):
+        pass
+
+def rr_thread():
+    wf = Roundrobin()
+    while True:
+        work()
+        yield wf()
+
+def timeout_thread():                                       # Shortest possible timeout: always overdue
+    wf = Timeout(0.000001)
+    while True:
+        work()
+        yield wf()
+
+def ready():                                                # Poll function: always ready
+    return 1
+
+def poll_thread():
+    wf = Poller(ready)
+    while True:
+        work()
+        yield wf()
+
+# USER TEST PROGRAM
+
+def test(duration = 1):
+    print("Scheduler overhead (%) for each Waitfor type against thread count")
+    counts = (1, 2, 5, 10, 20)
+    print("{:12s}".format("Threads") + "".join("{:7d}".format(n) for n in counts))
+    for name, thread in (("Roundrobin", rr_thread), ("Timeout", timeout_thread), ("Poller", poll_thread)):
+        results = []
+        for nthreads in counts:
+            objSched = Sched()
+            for n in range(nthreads):
+                objSched.add_thread(thread())
+            objSched.add_thread(stop(duration, objSched))
+            objSched.profile_enable()
+            objSched.run()
+            results.append(100*objSched.profile_overhead())
+        print("{:12s}".format(name) + "".join("{:7.1f}".format(r) for r in results))
+    print("Breakdown for the last run:")
+    objSched.profile_report()
+
+test(1)
@@ -0,0 +1,83 @@
+# shardbench.py Benchmark of a CPU bound workload on a sharded scheduler
+# Author: Peter Hinch
+
+# Run on a host PC under CPython, with the lib directory on the path:
+# PYTHONPATH=lib python3 shardbench.py
+# A fixed number of CPU bound threads, each doing a fixed amount of work in slices separated by Roundrobin yields, is
+# run on 1, 2, 4... shards up to the number of cores. Throughput (slices/s) should scale with the number of shards
+# until the cores are used up. A producer and consumer on different shards demonstrate a channel.
+
+import os
+import time
+from usched import Roundrobin
+from shard import ShardedSched, leastloaded_policy
+
+THREADS = 8
+SLICES = 200                                                # Per thread
+WORK = 20000                                                # Loop iterations per slice
+
+# THREADS (module level so that they can be pickled)
+
+def cruncher():
+    wf = Roundrobin()
+    for n in range(SLICES):
+        total = 0
+        for x in range(WORK):
+            total += x
+        yield wf()
+
+def producer(chan, count):
+    wf = Roundrobin()
+    for n in range(count):
+        chan.put(n)
+        yield wf()
+    chan.put(None)                                          # End of data
+
+def consumer(chan, results):
+    total = 0
+    while True:
+        item = yield from chan.get()
+        if item is None:
+            break
+        total += item
+    results.put(total)
+
+# USER TEST PROGRAM
+
+def bench(nshards):
+    objSched = ShardedSched(nshards, leastloaded_policy)
+    for n in range(THREADS):
+        objSched.add_thread(cruncher)
+    start = time.perf_counter()
+    objSched.run()
+    elapsed = time.perf_counter() - start
+    stats = objSched.stats()
+    return THREADS*SLICES/elapsed, stats['overhead']
+
+def channeltest():
+    objSched = ShardedSched(2)
+    chan = objSched.channel()
+    results = objSched.channel()
+    objSched.add_thread(producer, (chan, 1000))             # Round robin policy: shard 0
+    objSched.add_thread(consumer, (chan, results))          # shard 1
+    objSched.run()
+    total = results.queue.get()
+    print("Channel test: consumer received total {:d} ({:s})".format(total, "OK" if total == 499500 else "FAIL"))
+
+def test():
+    cores = os.cpu_count() or 1
+    print("{:d} threads, {:d} cores".format(THREADS, cores))
+    print("Shards  Slices/s  Speedup  Overhead")
+    nshards = 1
+    base = None
+    while True:
+        rate, overhead = bench(nshards)
+        base = base or rate
+        print("{:6d}{:10.0f}{:9.2f}{:9.1f}%".format(nshards, rate, rate/base, 100*overhead))
+        if nshards >= cores:
+            break
+        nshards = min(2*nshards, cores)
+    channeltest()
+
+if __name__ == '__main__':
+    test()
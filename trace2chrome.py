@@ -0,0 +1,62 @@
+# trace2chrome.py Convert a usched trace dump to Chrome trace-event JSON
+# Author: Peter Hinch
+
+# Run on a host PC under CPython, not on the MicroPython board.
+# Capture the output of Sched.trace_dump() from the REPL into a file (e.g. with a terminal program's logging feature)
+# then issue
+# python3 trace2chrome.py dumpfile trace.json
+# and load trace.json into Perfetto (https://ui.perfetto.dev) or chrome://tracing. Each usched thread appears as a
+# track: each execution is a slice labelled with the reason the thread was woken.
+# Lines outside the dump (REPL echo etc.) are ignored. If the file holds more than one dump the last one is used.
+
+import sys
+import json
+
+TIMERPERIOD = 0x7fffffff                                    # As per usched.py
+REASONS = ('roundrobin', 'interrupt', 'poll', 'timeout')    # Indexed by usched TRACE_ constants
+
+def parse(lines):                                           # Return a list of (tid, reason, start, end) tuples
+    records = None
+    for line in lines:
+        fields = line.split()
+        if fields[:2] == ['usched', 'trace']:               # Start of a dump
+            records = []
+        elif records is not None and len(fields) == 4:
+            try:
+                records.append(tuple(int(f) for f in fields))
+            except ValueError:
+                pass
+    return records or []
+
+def convert(records):                                       # Return a dict of Chrome trace events
+    events = []
+    offset = 0                                              # Undo timer wraparound: records are in time order
+    last = None
+    for tid, reason, start, end in records:
+        ts = start + offset
+        if last is not None and ts < last - TIMERPERIOD//2: # Timer has wrapped since the last record
+            offset += TIMERPERIOD + 1
+            ts += TIMERPERIOD + 1
+        last = ts
+        dur = (end - start) & TIMERPERIOD
+        name = REASONS[reason] if reason < len(REASONS) else str(reason)
+        events.append({'name' : name, 'cat' : 'usched', 'ph' : 'X', 'ts' : ts, 'dur' : dur,
+                       'pid' : 1, 'tid' : tid, 'args' : {'reason' : name}})
+    for tid in sorted(set(r[0] for r in records)):          # Name the tracks
+        events.append({'name' : 'thread_name', 'ph' : 'M', 'pid' : 1, 'tid' : tid,
+                       'args' : {'name' : 'thread {:d}'.format(tid)}})
+    return {'traceEvents' : events, 'displayTimeUnit' : 'ms'}
+
+def main(argv):
+    if len(argv) != 3:
+        print('Usage: trace2chrome.py dumpfile outfile.json')
+        return 1
+    with open(argv[1]) as f:
+        records = parse(f)
+    with open(argv[2], 'w') as f:
+        json.dump(convert(records), f)
+    print('{:d} records converted'.format(len(records)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,42 @@
+# tracetest.py Demo of the scheduler's trace facility
+# Author: Peter Hinch
+
+import pyb
+from usched import Sched, Roundrobin, Timeout, wait
+
+# Run on MicroPython board bare hardware
+# Runs three round robin threads and one which toggles an LED. Prints the trace when the scheduler stops: capture the
+# output and convert it with trace2chrome.py on a PC.
+
+# THREADS:
+
+def stop(fTim, objSch):                                     # Stop the scheduler after fTim seconds
+    yield from wait(fTim)
+    objSch.stop()
+
+def robin(count):                                           # Does a variable amount of work per execution
+    wf = Roundrobin()
+    while True:
+        for x in range(count):
+            pass
+        yield wf()
+
+def toggle(objLED, period):
+    wf = Timeout(period)
+    while True:
+        yield wf()
+        objLED.toggle()
+
+# USER TEST PROGRAM
+
+def test(duration = 1):
+    objSched = Sched()
+    objSched.trace_enable(200)                              # Keep the 200 most recent executions
+    for count in (10, 100, 1000):
+        objSched.add_thread(robin(count))
+    objSched.add_thread(toggle(pyb.LED(1), 0.05))
+    objSched.add_thread(stop(duration, objSched))
+    objSched.run()
+    objSched.trace_dump()
+
+test(1)